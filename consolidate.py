@@ -0,0 +1,57 @@
+"""Consolidates the downloaded radar files into a single HDF5 store.
+
+Opening and closing thousands of small HDF5 files dominates the time spent in
+preprocess.py. This script reads every file once and writes the (already
+masked) images into one (T, H, W) dataset, chunked per image, together with
+the original filenames. preprocess.py reads from this store when it exists.
+
+Re-run this script (or delete the store) after downloading new files.
+"""
+
+import logging
+
+import h5py
+import numpy as np
+from tqdm import tqdm
+
+from preprocess import CONSOLIDATED_STORE, DATA_DIR, read_radar_file
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def main():
+    radar_files = sorted(DATA_DIR.glob("*.h5"))
+    if not radar_files:
+        logger.error(f"No radar files found in {DATA_DIR}")
+        return
+
+    with h5py.File(radar_files[0], "r") as f:
+        shape = f["image1/image_data"].shape
+        dtype = f["image1/image_data"].dtype
+
+    with h5py.File(CONSOLIDATED_STORE, "w") as store:
+        images = store.create_dataset(
+            "images", shape=(len(radar_files), *shape), dtype=dtype, chunks=(1, *shape)
+        )
+        store["filenames"] = [f.name for f in radar_files]
+        # Files that can't be read are kept as rows, but marked as invalid
+        valid = np.zeros(len(radar_files), dtype=bool)
+
+        for i, f in enumerate(tqdm(radar_files, desc="Consolidating radar files")):
+            try:
+                images[i] = read_radar_file(f, reuse_buffer=True)
+                valid[i] = True
+            except Exception as e:
+                logger.error(f"Error reading {f}: {e}")
+
+        store["valid"] = valid
+
+    logger.info(
+        f"Wrote {valid.sum()} of {len(radar_files)} images to {CONSOLIDATED_STORE}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -18,11 +18,16 @@ except that the files I got from there have "rt" in the filename instead of "5m"
 """
 
 import datetime
+import functools
 import logging
 import os
+import queue
+import shutil
 import sys
 import tarfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import requests
@@ -35,8 +40,11 @@ logger = logging.getLogger(__name__)
 logger.setLevel(os.environ.get("LOG_LEVEL", logging.INFO))
 
 DATAPATH = Path("~/weathergenerator/data").expanduser()
+MAX_WORKERS = 8
+CHUNK_SIZE = 1 << 20  # 1 MiB reads from the network
 
 
+@functools.cache
 def get_token():
     """Get the KNMI API token, stored in .env as "KNMI_TOKEN".
 
@@ -53,12 +61,31 @@ def get_token():
     return token
 
 
+class RateLimiter:
+    """Allow at most one call per `interval` seconds, shared between threads."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next_call = time.monotonic()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next_call - now
+            self._next_call = max(now, self._next_call) + self.interval
+
+        if delay > 0:
+            time.sleep(delay)
+
+
 class DatasetAPI:
     def __init__(self, dataset_name, dataset_version):
         self.base_url = "https://api.dataplatform.knmi.nl/open-data/v1"
         self.dataset_name = dataset_name
         self.dataset_version = dataset_version
 
+        self.rate_limiter = RateLimiter(interval=0.5)  # Avoid hitting rate limits
         self.session = self.__create_session()
         self.session.headers.update({"Authorization": get_token()})
 
@@ -66,14 +93,18 @@ class DatasetAPI:
         session = requests.Session()
 
         retries = Retry(total=5, backoff_factor=0.5)
-        adapter = HTTPAdapter(max_retries=retries)
+        # One pool for the API host and one for the download host, each large
+        # enough to keep a connection alive for every worker thread
+        adapter = HTTPAdapter(
+            pool_connections=2, pool_maxsize=MAX_WORKERS, max_retries=retries
+        )
         session.mount("https://", adapter)
         session.mount("http://", adapter)
 
         return session
 
     def __get_data(self, url, params=None):
-        time.sleep(0.5)  # Avoid hitting rate limits
+        self.rate_limiter.wait()
         response = self.session.get(url, params=params)
         response.raise_for_status()
         return response.json()
@@ -90,48 +121,191 @@ class DatasetAPI:
         )
         return response.get("temporaryDownloadUrl")
 
-    def download_file(self, filename: str, path: Path, overwrite=False):
-        if (path / filename).exists() and not overwrite:
-            logger.info(f"File {path / filename} already exists, skipping download.")
+    def download_file(
+        self, filename: str, path: Path, overwrite=False, download_url=None
+    ):
+        """Download a file into `path`.
+
+        Tar archives are extracted while they are being downloaded, so only
+        their members and an empty `<filename>.extracted` marker are written.
+        Other files are written to `<filename>.part` first, and an interrupted
+        download is resumed from there on the next call.
+
+        `download_url` is a temporary URL from get_file_url(), which is
+        requested here if it isn't given.
+        """
+        is_tar = filename.endswith(".tar")
+        target = download_target(filename, path)
+        if target.exists() and not overwrite:
+            logger.info(f"File {target} already exists, skipping download.")
             return
 
         logger.info(f"Downloading file: {filename}")
-        download_url = self.get_file_url(filename)
-
-        with requests.get(download_url, stream=True) as r:
-            r.raise_for_status()
-            with open(path / filename, "wb") as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
-
-        logger.info(f"Successfully downloaded dataset file to {path / filename}")
+        if download_url is None:
+            download_url = self.get_file_url(filename)
+
+        if is_tar:
+            with (
+                self.__open_download(download_url) as r,
+                tarfile.open(fileobj=r.raw, mode="r|", bufsize=CHUNK_SIZE) as tar,
+            ):
+                extract_members(tar, path)
+            target.touch()
+        else:
+            part = path / f"{filename}.part"
+            if overwrite:
+                part.unlink(missing_ok=True)
+            start = part.stat().st_size if part.exists() else 0
+
+            r = self.__open_download(download_url, start)
+            if r.status_code == 416 and (
+                r.headers.get("Content-Range") == f"bytes */{start}"
+            ):
+                # The previous run stopped after the download, before the rename
+                r.close()
+            else:
+                # 200: the server sent the whole file, which replaces the .part.
+                # Anything else that doesn't continue at `start` (416 for a .part
+                # longer than the file, another range) can't be appended to it.
+                if start and r.status_code != 200 and not resumes_at(r, start):
+                    logger.info(f"Can't resume {filename}, downloading it again")
+                    r.close()
+                    start = 0
+                    r = self.__open_download(download_url)
+                mode = "ab" if start and r.status_code == 206 else "wb"
+                with r, open(part, mode) as f:
+                    shutil.copyfileobj(r.raw, f, length=CHUNK_SIZE)
+            part.replace(target)
+
+        logger.info(f"Successfully downloaded dataset file {filename} to {path}")
+
+    def __open_download(self, download_url, start=0):
+        # The temporary URL is pre-signed, don't send the API token along
+        headers = {"Authorization": None}
+        if start:
+            logger.info(f"Resuming download at byte {start}")
+            headers["Range"] = f"bytes={start}-"
+            # The offset is in the bytes on disk, so ask for them unencoded
+            headers["Accept-Encoding"] = "identity"
+
+        r = self.session.get(download_url, stream=True, headers=headers)
+        try:
+            # 416 is handled by the caller, the .part may be complete already
+            if not (start and r.status_code == 416):
+                r.raise_for_status()
+        except requests.HTTPError:
+            r.close()
+            raise
+        r.raw.decode_content = True
+        return r
+
+
+def download_target(filename: str, path: Path) -> Path:
+    """The file that exists in `path` once `filename` has been downloaded."""
+    if filename.endswith(".tar"):
+        return path / f"{filename}.extracted"
+    return path / filename
+
+
+def resumes_at(r: requests.Response, start: int) -> bool:
+    """Whether the response continues an unencoded download at byte `start`."""
+    return (
+        r.status_code == 206
+        and r.headers.get("Content-Encoding", "identity") == "identity"
+        and r.headers.get("Content-Range", "").startswith(f"bytes {start}-")
+    )
+
+
+def download_files(api: DatasetAPI, filenames, path: Path):
+    """Download files with MAX_WORKERS threads.
+
+    A separate thread requests the temporary download URLs (the rate limited
+    part) ahead of the workers, so these requests overlap with the transfers.
+    The queue is bounded so the URLs don't expire before they are used.
+    """
+    url_queue = queue.Queue(maxsize=MAX_WORKERS)
+    failed = []
+
+    def request_urls():
+        try:
+            for filename in filenames:
+                if download_target(filename, path).exists():
+                    logger.info(f"File {filename} already downloaded, skipping.")
+                    continue
+                try:
+                    url_queue.put((filename, api.get_file_url(filename)))
+                except requests.RequestException as e:
+                    logger.error(f"Failed to get download URL for {filename}: {e}")
+                    failed.append(filename)
+        finally:
+            for _ in range(MAX_WORKERS):
+                url_queue.put(None)
+
+    def download():
+        while (item := url_queue.get()) is not None:
+            filename, download_url = item
+            try:
+                api.download_file(filename, path, download_url=download_url)
+            except Exception as e:
+                logger.error(f"Failed to download {filename}: {e}")
+                failed.append(filename)
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS + 1) as executor:
+        futures = [executor.submit(request_urls)]
+        futures += [executor.submit(download) for _ in range(MAX_WORKERS)]
+        for future in futures:
+            future.result()
+
+    if failed:
+        raise RuntimeError(f"Failed to download {len(failed)} files: {failed}")
+
+
+def extract_members(tar, path):
+    """Extract the members of an open tar archive into `path`, in archive order."""
+    # One directory listing instead of a stat() per member; only members in
+    # subdirectories (not used by KNMI) still need to be checked on disk
+    existing = {".", *(entry.name for entry in os.scandir(path))}
+    for member in tar:
+        name = os.path.normpath(member.name)
+        if name in existing or (os.sep in name and (path / name).exists()):
+            logger.info(f"Skipped (already exists): {member.name}")
+        else:
+            try:
+                tar.extract(member, path=path)
+            except BaseException:
+                # Don't leave a truncated member behind, the next run would skip it
+                if member.isfile():
+                    (path / name).unlink(missing_ok=True)
+                raise
+            existing.add(name)
+            logger.info(f"Extracted: {member.name}")
 
 
 def extract_tar(tar_path):
-    with tarfile.open(tar_path, "r") as tar:
-        for member in tar.getmembers():
-            member_path = tar_path.parent / member.name
-            if not member_path.exists():
-                tar.extract(member, path=tar_path.parent)
-                print(f"Extracted: {member.name}")
-            else:
-                print(f"Skipped (already exists): {member.name}")
+    """Extract an archive on disk and mark it as downloaded, like download_file."""
+    # Streaming mode reads one header at a time instead of indexing the archive
+    with tarfile.open(tar_path, "r|", bufsize=CHUNK_SIZE) as tar:
+        extract_members(tar, tar_path.parent)
+    download_target(tar_path.name, tar_path.parent).touch()
 
 
 def main():
     begin = datetime.date(2024, 1, 1).strftime("%Y-%m-%dT%H:%M:%S+00:00")
     end = datetime.date(2024, 2, 1).strftime("%Y-%m-%dT%H:%M:%S+00:00")
 
-    api = DatasetAPI(dataset_name="nl_rdr_data_rtcor_5m_tar", dataset_version="1.0")
-    response = api.list_files(maxKeys=31, orderBy="created", begin=begin, end=end)
+    # Archives downloaded before they were extracted on the fly
+    for tar_file in DATAPATH.glob("*.tar"):
+        if not download_target(tar_file.name, DATAPATH).exists():
+            extract_tar(tar_file)
 
-    for file in response["files"]:
-        filename = file.get("filename")
-        api.download_file(filename, DATAPATH)
+    api = DatasetAPI(dataset_name="nl_rdr_data_rtcor_5m_tar", dataset_version="1.0")
+    try:
+        response = api.list_files(maxKeys=31, orderBy="created", begin=begin, end=end)
 
-    # Extract all tar files in the data path
-    for tar_file in Path(DATAPATH).glob("*.tar"):
-        extract_tar(tar_file)
+        filenames = [file.get("filename") for file in response["files"]]
+        download_files(api, filenames, DATAPATH)
+    finally:
+        api.session.close()
 
 
 if __name__ == "__main__":
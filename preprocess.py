@@ -7,10 +7,12 @@ TODO: verify which thresholds to use.
 As opposed to Charlotte's scripts, this code generates a single CSV file with labels for all radar images.
 """
 
+import csv
+import functools
 import logging
+import multiprocessing
 from pathlib import Path
-import pandas as pd
-from skimage import morphology
+from scipy import ndimage
 
 import numpy as np
 from tqdm import tqdm
@@ -21,34 +23,127 @@ logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-CLUTTERMASK = np.load(Path(__file__).parent / "cluttermask.npy")
+# Used as a boolean `where=` mask, so the image is never upcast by multiplication
+CLUTTERMASK = np.load(Path(__file__).parent / "cluttermask.npy").astype(
+    bool, copy=False
+)
+EIGHT_CONNECTED = np.ones((3, 3), dtype=bool)
+CLUTTER_BAND_ROWS = 64
+BATCH_SIZE = 32  # Images per pool task
 
+DATA_DIR = Path("~/weathergenerator/data").expanduser()
+# Written by consolidate.py, used instead of the individual files if present
+CONSOLIDATED_STORE = DATA_DIR.parent / "radar_consolidated.h5"
 
-def read_radar_file(file: Path) -> np.ndarray:
-    with h5py.File(file, "r") as f:
-        image = f["image1"]["image_data"][:]
+
+@functools.cache
+def _scratch(name: str, shape: tuple, dtype) -> np.ndarray:
+    """A buffer that is reused by every call in this process (not thread-safe)."""
+    return np.empty(shape, dtype=dtype)
+
+
+def read_radar_file(file: Path, reuse_buffer=False) -> np.ndarray:
+    """Read the radar image from a KNMI HDF5 file.
+
+    With `reuse_buffer`, the image is read into a buffer that is shared by all
+    calls in this process, so the result is overwritten by the next call.
+    """
+    with h5py.File(file, "r", rdcc_nbytes=16 << 20) as f:
+        dataset = f["image1/image_data"]
+        if reuse_buffer:
+            image = _scratch("image", dataset.shape, dataset.dtype)
+        else:
+            image = np.empty(dataset.shape, dtype=dataset.dtype)
+        dataset.read_direct(image)
 
         ## Set pixels out of image to 0
-        ooi_value = f["image1"]["calibration"].attrs["calibration_out_of_image"]
-        image[image == ooi_value] = 0
+        # A Python int (not the stored int64 array) keeps the comparison in the
+        # image's own dtype, instead of upcasting the whole image
+        ooi_value = f["image1/calibration"].attrs["calibration_out_of_image"].item()
         # Sometimes 255 or other number (244) is used for the calibration
         # for out of image values, so also check the first pixel
-        image[image == image[0][0]] = 0
+        corner = image[0, 0]
+        out_of_image = image == corner
+        if corner != ooi_value:
+            out_of_image |= image == ooi_value
+        np.copyto(image, 0, where=out_of_image)
 
         return image
 
 
+def _doubled_gradient(image: np.ndarray, start: int, stop: int, dtype):
+    """Twice the np.gradient of rows `start:stop` of the image, in integers.
+
+    Central differences inside the image and doubled one-sided differences at
+    its edges, so the result matches np.gradient exactly without floats. The
+    returned arrays are scratch buffers, valid until the next call.
+    """
+    n_rows, n_cols = image.shape
+    lo, hi = max(start - 1, 0), min(stop + 1, n_rows)
+    img = _scratch("band", (CLUTTER_BAND_ROWS + 2, n_cols), dtype)[: hi - lo]
+    np.copyto(img, image[lo:hi])
+
+    # Rows with a neighbour on both sides get central differences
+    gx = _scratch("gx", (CLUTTER_BAND_ROWS, n_cols), dtype)[: stop - start]
+    first, last = max(start, 1), min(stop, n_rows - 1)
+    np.subtract(
+        img[first - lo + 1 : last - lo + 1],
+        img[first - lo - 1 : last - lo - 1],
+        out=gx[first - start : last - start],
+    )
+    if start == 0:
+        np.subtract(img[1], img[0], out=gx[0])
+        gx[0] *= 2
+    if stop == n_rows:
+        np.subtract(img[-1], img[-2], out=gx[-1])
+        gx[-1] *= 2
+
+    band = img[start - lo : stop - lo]
+    gy = _scratch("gy", (CLUTTER_BAND_ROWS, n_cols), dtype)[: stop - start]
+    np.subtract(band[:, 2:], band[:, :-2], out=gy[:, 1:-1])
+    np.subtract(band[:, 1], band[:, 0], out=gy[:, 0])
+    np.subtract(band[:, -1], band[:, -2], out=gy[:, -1])
+    gy[:, 0] *= 2
+    gy[:, -1] *= 2
+
+    return gx, gy
+
+
 def has_clutter(image: np.ndarray, threshold=500, min_pixels=130) -> bool:
     """Determine if the radar image contains clutter.
 
     An image is considered cluttered if the gradient magnitude exceeds
     the threshold for at least `pixel_threshold` pixels.
     """
-    gx, gy = np.gradient(image)
-    magnitude_squared = gx**2 + gy**2
-    clutter_pixels = magnitude_squared > threshold**2
+    if not np.issubdtype(image.dtype, np.integer):
+        # The integer arithmetic below would truncate or refuse floats
+        gx, gy = np.gradient(image)
+        return np.count_nonzero(gx**2 + gy**2 > threshold**2) > min_pixels
+
+    # The squared magnitude of the doubled gradient is at most 8 * (max - min)**2,
+    # so int32 is enough (and half the memory traffic) for a range up to 16383
+    value_range = int(image.max()) - int(image.min())
+    dtype = np.int32 if value_range <= 16383 else np.int64
+
+    # The image is processed in bands of rows, so the temporaries stay in
+    # cache and cluttered images are recognised without scanning all of it
+    clutter_pixels = 0
+    for start in range(0, image.shape[0], CLUTTER_BAND_ROWS):
+        stop = min(start + CLUTTER_BAND_ROWS, image.shape[0])
+        gx, gy = _doubled_gradient(image, start, stop, dtype)
 
-    return np.sum(clutter_pixels) > min_pixels
+        # Squared magnitude of the doubled gradient, compared to (2 * threshold)**2
+        np.multiply(gx, gx, out=gx)
+        np.multiply(gy, gy, out=gy)
+        np.add(gx, gy, out=gx)
+        above = _scratch("above", (CLUTTER_BAND_ROWS, image.shape[1]), bool)
+        above = np.greater(gx, 4 * threshold**2, out=above[: stop - start])
+
+        clutter_pixels += np.count_nonzero(above)
+        if clutter_pixels > min_pixels:
+            return True
+
+    return False
 
 
 def is_rainy(image: np.ndarray) -> bool:
@@ -57,32 +152,135 @@ def is_rainy(image: np.ndarray) -> bool:
     TODO: I don't understand where 30mm / 3000 comes from
     Compare to average computation in Charlotte's heavy rain labeler.
     """
-    # Mask out blobs < 15 pixels and pixels that tend to contain clutter
-    valid_objects = morphology.remove_small_objects(
-        image > 0, min_size=9, connectivity=8
+    # Removing small blobs can only lower the sum of the positive pixels, so dry
+    # images are rejected before the (much more expensive) labelling. The sums
+    # use NumPy's default accumulator, so floats are not truncated to integers.
+    rain = np.greater(image, 0, out=_scratch("rain", image.shape, bool))
+    candidates = np.logical_and(
+        rain, CLUTTERMASK, out=_scratch("candidates", image.shape, bool)
     )
-    true_showers = image * valid_objects * CLUTTERMASK
+    if np.sum(image, where=candidates) <= 3000:
+        return False
 
-    return np.sum(true_showers) > 3000 and not has_clutter(image)
+    # Mask out blobs < 15 pixels and pixels that tend to contain clutter
+    labels = _scratch("labels", image.shape, np.int32)
+    ndimage.label(rain, structure=EIGHT_CONNECTED, output=labels)
+    keep = np.bincount(labels.ravel()) >= 9
+    keep[0] = False  # background
+    valid_objects = np.take(keep, labels, out=rain)
+    valid_objects &= CLUTTERMASK
+    true_showers = np.sum(image, where=valid_objects)
 
+    return true_showers > 3000 and not has_clutter(image)
 
-def main():
-    data_dir = Path("~/weathergenerator/data").expanduser()
-    radar_files = sorted(data_dir.glob("*.h5"))
 
-    results = []
-    for f in tqdm(radar_files, desc="Processing radar files"):
+def process_file(file: Path) -> dict:
+    """Label a single radar file, or log the error and label it as None."""
+    try:
+        image = read_radar_file(file, reuse_buffer=True)
+        rainy = is_rainy(image)
+    except Exception as e:
+        logger.error(f"Error processing {file}: {e}")
+        rainy = None
+
+    return {"filename": file.name, "rainy": rainy}
+
+
+def process_files(files: list) -> list:
+    """Label a batch of radar files, see process_file."""
+    return [process_file(file) for file in files]
+
+
+_store = {}
+
+
+def _open_store(path: Path):
+    """Pool initializer: keep the consolidated store open in every worker."""
+    f = h5py.File(path, "r", rdcc_nbytes=16 << 20)
+    _store["images"] = f["images"]
+    _store["filenames"] = f["filenames"].asstr()[:]
+    _store["valid"] = f["valid"][:]
+
+
+def process_frames(frames: range) -> list:
+    """Label a batch of consecutive images of the consolidated store.
+
+    The whole batch is read with a single hyperslab read, but is_rainy still
+    runs per image, which keeps its working set in cache.
+    """
+    results = [{"filename": _store["filenames"][t], "rainy": None} for t in frames]
+    images = _store["images"]
+    batch = _scratch("batch", (BATCH_SIZE, *images.shape[1:]), images.dtype)
+    batch = batch[: len(frames)]
+    try:
+        images.read_direct(batch, np.s_[frames.start : frames.stop])
+    except Exception as e:
+        logger.error(f"Error reading {results[0]['filename']} and onwards: {e}")
+        return results
+
+    for result, image, valid in zip(results, batch, _store["valid"][frames]):
+        if not valid:
+            continue
         try:
-            image = read_radar_file(f)
-            rainy = is_rainy(image)
+            result["rainy"] = is_rainy(image)
         except Exception as e:
-            logger.error(f"Error processing {f}: {e}")
-            rainy = None
+            logger.error(f"Error processing {result['filename']}: {e}")
+
+    return results
+
+
+def _store_is_current(radar_files: list) -> bool:
+    """Whether the consolidated store holds exactly the files in DATA_DIR."""
+    if not CONSOLIDATED_STORE.exists():
+        return False
+
+    with h5py.File(CONSOLIDATED_STORE, "r") as f:
+        stored = list(f["filenames"].asstr()[:])
+    if stored != [file.name for file in radar_files]:
+        logger.warning(
+            f"{CONSOLIDATED_STORE} is out of date ({len(stored)} images, "
+            f"{len(radar_files)} files in {DATA_DIR}), reading the files instead. "
+            "Re-run consolidate.py to use it again."
+        )
+        return False
+
+    return True
+
+
+def main():
+    radar_files = sorted(DATA_DIR.glob("*.h5"))
+    n_images = len(radar_files)
 
-        results.append({"filename": f.name, "rainy": rainy})
+    if _store_is_current(radar_files):
+        logger.info(f"Reading radar images from {CONSOLIDATED_STORE}")
+        batches = [
+            range(i, min(i + BATCH_SIZE, n_images))
+            for i in range(0, n_images, BATCH_SIZE)
+        ]
+        worker = process_frames
+        pool_kwargs = {"initializer": _open_store, "initargs": (CONSOLIDATED_STORE,)}
+    else:
+        batches = [
+            radar_files[i : i + BATCH_SIZE] for i in range(0, n_images, BATCH_SIZE)
+        ]
+        worker, pool_kwargs = process_files, {}
 
-    df = pd.DataFrame(results)
-    df.to_csv("rainy_labels.csv", index=False)
+    # Batches are independent, so spread them over all cores. imap (rather than
+    # imap_unordered) keeps the CSV in the same sorted order as before.
+    # Rows are written per batch, so a crash doesn't lose finished work.
+    with (
+        multiprocessing.Pool(**pool_kwargs) as pool,
+        open("rainy_labels.csv", "w", newline="") as fh,
+        tqdm(total=n_images, desc="Processing radar files") as progress,
+    ):
+        writer = csv.DictWriter(
+            fh, fieldnames=["filename", "rainy"], lineterminator="\n"
+        )
+        writer.writeheader()
+        for results in pool.imap(worker, batches):
+            writer.writerows(results)
+            fh.flush()
+            progress.update(len(results))
 
 
 if __name__ == "__main__":